@@ -1,20 +1,8 @@
 """A SKLearn-style wrapper around our PyTorch models (like Graph Convolutional Network and SparseLogisticRegression) implemented in models.py"""
 
-import logging
-import time
-import itertools
-import sklearn
-import sklearn.model_selection
-import sklearn.metrics
-import sklearn.linear_model
-import sklearn.neural_network
-import sklearn.tree
 import numpy as np
 import torch
-import torch.nn.functional as F
 from torch import nn
-from torch.autograd import Variable
-from scipy import sparse
 from models.utils import *
 from models.models import Model
 from models.gcn_layers import *
@@ -49,7 +37,6 @@ class GCN(Model):
 
         torch.manual_seed(self.seed)
         if self.on_cuda:
-            torch.cuda.manual_seed(self.seed)
             torch.cuda.manual_seed_all(self.seed)
             self.cuda()
 
@@ -59,28 +46,24 @@ class GCN(Model):
         if self.embedding:
             x = self.emb(x)
 
-        for i, [conv, gate, dropout] in enumerate(zip(self.conv_layers, self.gating_layers, self.dropout_layers)):
+        for i, conv in enumerate(self.conv_layers):
             for prepool_conv in self.prepool_conv_layers[i]:
                 x = prepool_conv(x)
 
-            if self.gating > 0.:
-                x = conv(x)
-                g = gate(x)
-                x = g * x
-            else:
-                x = conv(x)
+            x = conv(x)
+            if self.has_gate:
+                x = self.gating_layers[i](x) * x
 
-            if dropout is not None:
-                id_to_keep = dropout(torch.FloatTensor(np.ones((x.size(0), x.size(1))))).unsqueeze(2)
-                if self.on_cuda:
-                    id_to_keep = id_to_keep.cuda()
+            if self.has_dropout:
+                # Drop whole nodes, with the mask built on x's device
+                id_to_keep = self.dropout_layers[i](x.new_ones((x.size(0), x.size(1), 1)))
                 x = x * id_to_keep
 
         # Do attention pooling here
         if self.attention_head:
             x = self.attention_layer(x)[0]
 
-        x = self.my_logistic_layers[-1](x.view(nb_examples, -1))
+        x = self.my_logistic_layers[-1](torch.flatten(x, 1))
         return x
 
 
@@ -88,36 +71,41 @@ class GCN(Model):
         self.emb = EmbeddingLayer(self.nb_nodes, self.embedding)
 
     def add_dropout_layers(self):
-        self.dropout_layers = [None] * (len(self.dims) - 1)
-        if self.dropout:
+        self.has_dropout = bool(self.dropout)
+        self.dropout_layers = nn.ModuleList([])
+        if self.has_dropout:
             self.dropout_layers = nn.ModuleList([torch.nn.Dropout(int(self.dropout)*min((id_layer+1) / 10., 0.4)) for id_layer in range(len(self.dims)-1)])
 
     def add_graph_convolutional_layers(self):
         convs = []
         prepool_convs = nn.ModuleList([])
+        device = 'cuda' if self.on_cuda else 'cpu'
         for i, [c_in, c_out] in enumerate(zip(self.dims[:-1], self.dims[1:])):
+            # One adjacency tensor per graph level, already on the target device so that
+            # moving the model keeps it shared between the layers instead of copying it per layer
+            adj_matrix = adjacency_tensor(self.adjs[i]).to(device)
+
             # transformation to apply at each layer.
             extra_layers = []
             for _ in range(self.prepool_extralayers):
-                extra_layer = GCNLayer(self.adjs[i], c_in, c_in, self.on_cuda, i, torch.LongTensor(np.array(range(self.adjs[i].shape[0]))))
+                extra_layer = GCNLayer(adj_matrix, c_in, c_in, i, torch.arange(self.adjs[i].shape[0]))
                 extra_layers.append(extra_layer)
 
             prepool_convs.append(nn.ModuleList(extra_layers))
 
-            layer = GCNLayer(self.adjs[i], c_in, c_out, self.on_cuda, i, torch.tensor(self.centroids[i]))
+            layer = GCNLayer(adj_matrix, c_in, c_out, i, torch.tensor(self.centroids[i]))
             convs.append(layer)
         self.conv_layers = nn.ModuleList(convs)
         self.prepool_conv_layers = prepool_convs
 
     def add_gating_layers(self):
-        if self.gating > 0.:
-            gating_layers = []
+        self.has_gate = self.gating > 0.
+        gating_layers = []
+        if self.has_gate:
             for c_in in self.channels:
                 gate = ElementwiseGateLayer(c_in)
                 gating_layers.append(gate)
-            self.gating_layers = nn.ModuleList(gating_layers)
-        else:
-            self.gating_layers = [None] * (len(self.dims) - 1)
+        self.gating_layers = nn.ModuleList(gating_layers)
 
     def add_logistic_layer(self):
         logistic_layers = []
@@ -131,19 +119,25 @@ class GCN(Model):
         self.my_logistic_layers = nn.ModuleList(logistic_layers)
 
     def get_representation(self):
+        def to_host(tensor):
+            # Only queues the device to host copy; all of them are waited on once at the end
+            return tensor.detach().to('cpu', non_blocking=True)
+
         def add_rep(layer, name, rep):
-            rep[name] = {'input': layer.input[0].cpu().data.numpy(), 'output': layer.output.cpu().data.numpy()}
+            rep[name] = {'input': to_host(layer.input[0]), 'output': to_host(layer.output)}
 
+        if not self.monitor_hooks:
+            raise Exception("call enable_monitoring() and run a forward pass before get_representation")
         representation = {}
 
         if self.embedding:
             add_rep(self.emb, 'emb', representation)
 
-        for i, [layer, gate] in enumerate(zip(self.conv_layers, self.gating_layers)):
+        for i, layer in enumerate(self.conv_layers):
 
-            if self.gating > 0.:
+            if self.has_gate:
                 add_rep(layer, 'layer_{}'.format(i), representation)
-                add_rep(gate, 'gate_{}'.format(i), representation)
+                add_rep(self.gating_layers[i], 'gate_{}'.format(i), representation)
 
             else:
                 add_rep(layer, 'layer_{}'.format(i), representation)
@@ -151,11 +145,33 @@ class GCN(Model):
         add_rep(self.my_logistic_layers[-1], 'logistic', representation)
 
         if self.attention_head:
-            representation['attention'] = {'input': self.attention_layer.input[0].cpu().data.numpy(),
-                         'output': [self.attention_layer.output[0].cpu().data.numpy(), self.attention_layer.output[1].cpu().data.numpy()]}
+            representation['attention'] = {'input': to_host(self.attention_layer.input[0]),
+                         'output': [to_host(self.attention_layer.output[0]), to_host(self.attention_layer.output[1])]}
 
+        if self.on_cuda:
+            torch.cuda.synchronize()
+        for rep in representation.values():
+            rep['input'] = rep['input'].numpy()
+            rep['output'] = [o.numpy() for o in rep['output']] if isinstance(rep['output'], list) else rep['output'].numpy()
         return representation
 
+    def to_inference(self):
+        """
+        Quantize the small gate and attention Linear layers to int8 for CPU inference.
+        Their outputs only go through a sigmoid or softmax, so the precision loss is negligible.
+        Needs torchao (torch.ao.quantization.quantize_dynamic is deprecated).
+        The model can't be trained any further afterwards.
+        """
+        from torchao.quantization import quantize_, Int8DynamicActivationInt8WeightConfig
+        self.cpu()
+        self.eval()
+        small_layers = list(self.gating_layers)
+        if self.attention_head:
+            small_layers.append(self.attention_layer)
+        for layer in small_layers:
+            quantize_(layer, Int8DynamicActivationInt8WeightConfig())
+        return self
+
     # because of the sparse matrices.
     def load_state_dict(self, state_dict):
         own_state = self.state_dict()
@@ -1,92 +1,72 @@
-import logging
-import time
-import itertools
-import sklearn
-import sklearn.model_selection
-import sklearn.metrics
-import sklearn.linear_model
-import sklearn.neural_network
-import sklearn.tree
 import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
-from torch.autograd import Variable
 from scipy import sparse
 from models.utils import *
 
+def adjacency_tensor(adj):
+    adj = sparse.csr_matrix(adj)
+    nb_nodes = adj.shape[0]
+    if adj.nnz < 0.25 * nb_nodes ** 2:
+        # Sparse enough for a CSR product to be cheaper than a dense matmul
+        return torch.sparse_csr_tensor(torch.from_numpy(adj.indptr.astype(np.int64)),
+                                       torch.from_numpy(adj.indices.astype(np.int64)),
+                                       torch.from_numpy(adj.data.astype(np.float32)),
+                                       size=(nb_nodes, nb_nodes))
+    # The coarser graphs after pooling can be nearly dense
+    return torch.from_numpy(adj.toarray().astype(np.float32))
+
+
 class GCNLayer(nn.Module):
-    def __init__(self, adj, in_dim=1, channels=1, cuda=False, id_layer=None, centroids=None):
+    def __init__(self, adj, in_dim=1, channels=1, id_layer=None, centroids=None):
         super(GCNLayer, self).__init__()
 
         self.my_layers = []
-        self.cuda = cuda
         self.nb_nodes = adj.shape[0]
         self.in_dim = in_dim
         self.channels = channels
         self.id_layer = id_layer
-        self.adj = adj
-        self.centroids = centroids
-        edges = torch.LongTensor(np.array(self.adj.nonzero()))
-        sparse_adj = torch.sparse.FloatTensor(edges, torch.FloatTensor(self.adj.data), torch.Size([self.nb_nodes, self.nb_nodes]))
-        self.register_buffer('sparse_adj', sparse_adj)
+        # Layers on the same graph can share one prebuilt adjacency tensor
+        adj_matrix = adj if torch.is_tensor(adj) else adjacency_tensor(adj)
+        self.register_buffer('adj_matrix', adj_matrix)
+        # A buffer so it follows the module across .cuda()/.to() calls, kept out of the state_dict
+        self.register_buffer('centroids', centroids, persistent=False)
 
         self.linear = nn.Conv1d(in_channels=self.in_dim, out_channels=int(self.channels/2), kernel_size=1, bias=True)
         self.eye_linear = nn.Conv1d(in_channels=self.in_dim, out_channels=int(self.channels/2), kernel_size=1, bias=True)
 
-        self.sparse_adj = self.sparse_adj.cuda() if self.cuda else self.sparse_adj
-        self.centroids = self.centroids.cuda() if self.cuda else self.centroids
-        self.dense_adj = (self.sparse_adj.to_dense() > 0.).float()
-        self.dense_adj = self.dense_adj.cuda() if self.cuda else self.dense_adj
-
     def _adj_mul(self, x, D):
         nb_examples, nb_channels, nb_nodes = x.size()
         x = x.view(-1, nb_nodes)
 
-        # Needs this hack to work: https://discuss.pytorch.org/t/does-pytorch-support-autograd-on-sparse-matrix/6156/7
-        #x = D.mm(x.t()).t()
-        x = SparseMM(D)(x.t()).t()
+        if D.layout == torch.sparse_csr:
+            # autocast doesn't handle sparse products, so match the adjacency's dtype
+            x = torch.sparse.mm(D, x.t().to(D.dtype)).t()
+        else:
+            x = torch.mm(x, D.t())
 
         x = x.contiguous().view(nb_examples, nb_channels, nb_nodes)
         return x
 
+    def _pointwise(self, conv, x):
+        # A kernel size 1 Conv1d is a per-node linear map over the channels, run here as one batched matmul
+        weight = conv.weight.squeeze(-1).expand(x.size(0), -1, -1)
+        return torch.baddbmm(conv.bias.unsqueeze(-1), weight, x)
+
     def forward(self, x):
+        # Free when x comes from another GCNLayer, which already stores its features as (ex, channel, node)
         x = x.permute(0, 2, 1).contiguous()
 
-        adj = Variable(self.sparse_adj, requires_grad=False)
-
-        eye_x = self.eye_linear(x)
+        eye_x = self._pointwise(self.eye_linear, x)
 
-        x = self._adj_mul(x, adj)
+        x = self._adj_mul(x, self.adj_matrix)
 
-        x = torch.cat([self.linear(x), eye_x], dim=1).contiguous()
-        x = F.relu(x)
+        x = torch.cat([self._pointwise(self.linear, x), eye_x], dim=1)
+        x = F.relu_(x)
         x = torch.index_select(x, 2, self.centroids)
-        x = x.permute(0, 2, 1).contiguous()
-        return x
-
-
-class SparseMM(torch.autograd.Function):
-    """
-    Sparse x dense matrix multiplication with autograd support.
-    Implementation by Soumith Chintala:
-    https://discuss.pytorch.org/t/
-    does-pytorch-support-autograd-on-sparse-matrix/6156/7
-    From: https://github.com/tkipf/pygcn/blob/master/pygcn/layers.py
-    """
-
-    def __init__(self, sparse):
-        super(SparseMM, self).__init__()
-        self.sparse = sparse
-
-    def forward(self, dense):
-        return torch.mm(self.sparse, dense)
-
-    def backward(self, grad_output):
-        grad_input = None
-        if self.needs_input_grad[0]:
-            grad_input = torch.mm(self.sparse.t(), grad_output)
-        return grad_input
+        # (ex, node, channel) view over the (ex, channel, node) storage, no copy
+        return x.permute(0, 2, 1)
 
 
 class EmbeddingLayer(nn.Module):
@@ -98,8 +78,10 @@ class EmbeddingLayer(nn.Module):
         self.reset_parameters()
 
     def forward(self, x):
-        emb = x * self.emb
-        return emb
+        # Written as (ex, emb, node) storage so the GCNLayer that follows can permute it without a copy;
+        # the broadcast operand has to be contiguous in that layout for the product to inherit it
+        emb = torch.mul(x.transpose(1, 2), self.emb.t().contiguous())
+        return emb.transpose(1, 2)
 
     def reset_parameters(self):
         stdv = 1. / np.sqrt(self.emb.size(1))
@@ -116,16 +98,14 @@ class AttentionLayer(nn.Module):
 
     def forward(self, x):
         nb_examples, nb_nodes, nb_channels = x.size()
-        x = x.view(-1, nb_channels)
 
-        attn_weights = torch.exp(self.attn(x)*self.temperature)
-        attn_weights = attn_weights.view(nb_examples, nb_nodes, self.nb_attention_head)
-        attn_weights = attn_weights / attn_weights.sum(dim=1).unsqueeze(1)  # normalizing
+        # nn.Linear maps the last dimension, so the scores come out as (ex, node, head) directly
+        attn_weights = self.attn(x)*self.temperature
+        attn_weights = F.softmax(attn_weights, dim=1)  # normalizing over the nodes
 
-        x = x.view(nb_examples, nb_nodes, nb_channels)
-        attn_applied = x.unsqueeze(-1) * attn_weights.unsqueeze(-2)
-        attn_applied = attn_applied.sum(dim=1)
-        attn_applied = attn_applied.view(nb_examples, -1)
+        # weighted sum over the nodes as one batched matmul, without the (ex, node, channel, head) product
+        attn_applied = torch.einsum('bnc,bnh->bch', x, attn_weights)
+        attn_applied = torch.flatten(attn_applied, 1)
 
         return attn_applied, attn_weights
 
@@ -139,15 +119,13 @@ class SoftPoolingLayer(nn.Module):
         self.temperature = 1.
 
     def forward(self, x):
-        nb_examples, nb_nodes, nb_channels = x.size()
-        x = x.view(-1, nb_channels)
-
-        attn_weights = torch.exp(self.attn(x)*self.temperature)
-        attn_weights = attn_weights.view(nb_examples, nb_nodes, self.nb_attention_head)
-        attn_weights = attn_weights / attn_weights.sum(dim=1).unsqueeze(1)  # normalizing
-        attn_weights = attn_weights.sum(dim=-1)
+        attn_weights = self.attn(x)*self.temperature
+        attn_weights = F.softmax(attn_weights, dim=1)  # normalizing over the nodes
+        # Each head is its own distribution over the nodes and the pooling weight is their sum,
+        # which is not the same as one softmax over the summed logits
+        attn_weights = attn_weights.sum(dim=-1, keepdim=True)
 
-        return attn_weights.unsqueeze(-1)
+        return attn_weights
 
 
 class ElementwiseGateLayer(nn.Module):
@@ -157,21 +135,18 @@ class ElementwiseGateLayer(nn.Module):
         self.attn = nn.Linear(self.in_dim, 1, bias=True)
 
     def forward(self, x):
-        nb_examples, nb_nodes, nb_channels = x.size()
-        x = x.view(-1, nb_channels)
         gate_weights = torch.sigmoid(self.attn(x))
-        gate_weights = gate_weights.view(nb_examples, nb_nodes, 1)
         return gate_weights
 
 
 class StaticElementwiseGateLayer(nn.Module):
-    def __init__(self, in_dim):
+    def __init__(self, in_dim, nb_nodes):
         self.in_dim = in_dim
+        self.nb_nodes = nb_nodes
         super(StaticElementwiseGateLayer, self).__init__()
-        self.attn = nn.Parameter(torch.zeros(50), requires_grad=True) + 1.
+        self.attn = nn.Parameter(torch.ones(nb_nodes))
 
     def forward(self, x):
-        nb_examples, nb_nodes, nb_channels = x.size()
+        # One weight per node, independent of the input; broadcasts over examples and channels
         gate_weights = torch.sigmoid(self.attn)
-        gate_weights = gate_weights.view(nb_nodes, 1)
-        return gate_weights
+        return gate_weights.view(-1, 1)
@@ -33,16 +33,16 @@ class MLP(Model):
 
         torch.manual_seed(self.seed)
         if self.on_cuda:
-            torch.cuda.manual_seed(self.seed)
             torch.cuda.manual_seed_all(self.seed)
             self.cuda()
 
     def forward(self, x):
         nb_examples, nb_nodes, nb_channels = x.size()
-        x = x.permute(0, 2, 1).contiguous()  # from ex, node, ch, -> ex, ch, node
+        # A single input channel, so flattening (ex, node, ch) gives the same order as the old (ex, ch, node) copy
+        x = torch.flatten(x, 1)
         for layer in self.my_layers:
-            x = F.relu(layer(x.view(nb_examples, -1)))  # or relu, sigmoid...
+            x = F.relu_(layer(x))  # or relu, sigmoid...
             if self.dropout:
                 x = self.my_dropout(x)
-        x = self.last_layer(x.view(nb_examples, -1))
+        x = self.last_layer(x)
         return x
@@ -1,20 +1,13 @@
 """A SKLearn-style wrapper around our PyTorch models (like Graph Convolutional Network and SparseLogisticRegression) implemented in models.py"""
 
-import logging
 import time
-import itertools
 import sklearn
 import sklearn.model_selection
 import sklearn.metrics
-import sklearn.linear_model
-import sklearn.neural_network
-import sklearn.tree
 import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
-from torch.autograd import Variable
-from scipy import sparse
 from models.utils import *
 
 
@@ -24,7 +17,9 @@ class Model(nn.Module):
                  dropout=False, cuda=False, seed=0, adj=None, graph_name=None, aggregation=None, prepool_extralayers=0,
                  lr=0.0001, patience=10, agg_reduce=2, scheduler=False, metric=sklearn.metrics.accuracy_score,
                  optimizer=torch.optim.Adam, weight_decay=0.0001, batch_size=10, train_valid_split=0.8, 
-                 evaluate_train=True, verbose=True, full_data_cuda=True):
+                 evaluate_train=True, verbose=True, full_data_cuda=True, world_size=1, local_rank=0, dist_backend="nccl",
+                 compile_model=False, mixed_precision=False, reg_lambda=0., l1_lambda=0., eval_every=1,
+                 cuda_graph=False):
         self.name = name
         self.column_names = column_names
         self.num_layer = num_layer
@@ -53,22 +48,42 @@ class Model(nn.Module):
         self.verbose = verbose
         self.evaluate_train = evaluate_train
         self.full_data_cuda = full_data_cuda
+        self.world_size = world_size
+        self.local_rank = local_rank
+        self.dist_backend = dist_backend
+        self.compile_model = compile_model
+        self.mixed_precision = mixed_precision
+        self.reg_lambda = reg_lambda
+        self.l1_lambda = l1_lambda
+        self.eval_every = eval_every
+        self.cuda_graph = cuda_graph
+        self.monitor_hooks = []
         if self.verbose:
             print("Early stopping metric is " + self.metric.__name__)
         super(Model, self).__init__()
 
     def fit(self, X, y, adj=None):
+        if self.reg_lambda != 0. and not hasattr(self, 'regularization'):
+            raise Exception("reg_lambda is set but %s has no regularization" % type(self).__name__)
         self.adj = adj
         self.X = X
         self.y = y
+        is_main = True
+        if self.world_size > 1:
+            # One process per GPU, launched with torchrun (or torch.distributed.launch) which sets the env:// variables
+            if not torch.distributed.is_initialized():
+                torch.distributed.init_process_group(backend=self.dist_backend, init_method='env://')
+            if self.on_cuda:
+                torch.cuda.set_device(self.local_rank)
+            is_main = torch.distributed.get_rank() == 0
         self.setup_layers()
         x_train, x_valid, y_train, y_valid = sklearn.model_selection.train_test_split(X, y, stratify=y, train_size=self.train_valid_split, test_size=1-self.train_valid_split, random_state=self.seed)
         
         y_true = y_train # Save copy on CPU for evaluation
 
-        x_train = torch.FloatTensor(np.expand_dims(x_train, axis=2))
-        x_valid = torch.FloatTensor(np.expand_dims(x_valid, axis=2))
-        y_train = torch.FloatTensor(y_train)
+        x_train = torch.as_tensor(np.expand_dims(x_train, axis=2), dtype=torch.float32)
+        x_valid = torch.as_tensor(np.expand_dims(x_valid, axis=2), dtype=torch.float32)
+        y_train = torch.as_tensor(np.asarray(y_train), dtype=torch.long)
         if self.on_cuda and self.full_data_cuda:
             try:
                 x_train = x_train.cuda()
@@ -77,77 +92,182 @@ class Model(nn.Module):
             except:
                 # Move data to GPU batch by batch
                 self.full_data_cuda = False
-                
-        
-        criterion = torch.nn.CrossEntropyLoss(reduction='mean')
-        optimizer = self.optimizer(self.parameters(), lr=self.lr, weight_decay=self.weight_decay)
+        if self.on_cuda and not self.full_data_cuda:
+            # Page-locked memory lets the batch by batch copies run asynchronously
+            x_train, x_valid, y_train = x_train.cpu().pin_memory(), x_valid.cpu().pin_memory(), y_train.cpu().pin_memory()
+
+        net = self
+        train_sampler = None
+        if self.world_size > 1:
+            # The graph buffers are built identically on every rank, and sparse buffers can't be broadcast anyway
+            net = torch.nn.parallel.DistributedDataParallel(self, device_ids=[self.local_rank] if self.on_cuda else None,
+                                                            broadcast_buffers=False, bucket_cap_mb=25)
+            train_sampler = torch.utils.data.distributed.DistributedSampler(range(x_train.shape[0]), seed=self.seed)
+        if self.compile_model and hasattr(torch, 'compile'):
+            # The shapes are static, only the last (smaller) batch of an epoch adds a second graph
+            torch._dynamo.config.cache_size_limit = 64
+            # Dynamo can't trace sparse tensors, so the sparse adjacency products stay as graph breaks;
+            # anything without them is required to compile as a single graph
+            fullgraph = self.world_size == 1 and all(buf.layout == torch.strided for buf in self.buffers())
+            net = torch.compile(net, mode='max-autotune', dynamic=False, fullgraph=fullgraph)
+
+        use_amp = self.mixed_precision and self.on_cuda
+        # Replaying a captured step only pays off for the plain single GPU loop, and needs a capturable optimizer
+        use_graph = (self.cuda_graph and self.on_cuda and self.world_size == 1 and not use_amp and not self.compile_model
+                     and self.optimizer in (torch.optim.Adam, torch.optim.AdamW))
+        # A captured optimizer step has to keep its state on the GPU
+        optimizer_kwargs = {'capturable': True} if use_graph else {}
+        if self.optimizer in (torch.optim.Adam, torch.optim.AdamW):
+            # Update all the small parameter tensors with a few multi-tensor kernels instead of one launch each
+            optimizer_kwargs['fused' if self.on_cuda else 'foreach'] = True
+        # A float lr would be baked into the captured step; the scheduler updates a tensor lr in place instead
+        lr = torch.tensor(self.lr, device='cuda') if use_graph else self.lr
+        optimizer = self.optimizer(self.parameters(), lr=lr, weight_decay=self.weight_decay, **optimizer_kwargs)
         if self.scheduler:
             scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma = 0.9)
+        # Most runs have no regularization, so skip building those terms entirely
+        use_reg = self.reg_lambda != 0.
+        use_l1 = self.l1_lambda != 0.
+        l1_params = list(self.parameters()) if use_l1 else []
+
+        def training_loss(inputs, targets):
+            with torch.autocast('cuda', dtype=torch.bfloat16, enabled=use_amp):
+                y_pred = net(inputs)
+                loss = F.cross_entropy(y_pred, targets)
+                if use_reg:
+                    loss = loss + self.regularization(self.reg_lambda)
+                if use_l1:
+                    loss = loss + calculate_l1_loss(l1_params, self.l1_lambda)
+            return loss
+        graph = None
 
         max_valid = 0
         patience = self.start_patience
         self.best_model = self.state_dict().copy()
+        # Dropout is the only train/eval dependent layer, so evaluation only flips those modules
+        dropout_modules = [module for module in self.modules() if isinstance(module, nn.Dropout)]
+        self.train()
         all_time = time.time()
         epoch = 0 # when num_epoch is set to 0 for testing
         for epoch in range(0, self.num_epochs):
             start = time.time()
-            for i in range(0, x_train.shape[0], self.batch_size):
-                inputs, labels = x_train[i:i + self.batch_size], y_train[i:i + self.batch_size]
-
-                inputs = Variable(inputs, requires_grad=False).float()
+            x_epoch, y_epoch = x_train, y_train
+            if train_sampler is not None:
+                # Each rank trains on its own shard of the training set
+                train_sampler.set_epoch(epoch)
+                idx = torch.tensor(list(train_sampler), device=x_train.device)
+                x_epoch, y_epoch = x_train[idx], y_train[idx]
                 if self.on_cuda and not self.full_data_cuda:
-                    inputs = inputs.cuda()
-                    labels = labels.cuda()
-
-                self.train()
-                y_pred = self(inputs)
+                    x_epoch, y_epoch = x_epoch.pin_memory(), y_epoch.pin_memory()
+            batches = zip(get_every_n(x_epoch, self.batch_size), get_every_n(y_epoch, self.batch_size))
+            if self.on_cuda and not self.full_data_cuda:
+                batches = CUDAPrefetcher(batches)
+            batch_losses = []
+            for i, (inputs, targets) in zip(range(0, x_epoch.shape[0], self.batch_size), batches):
+                if use_graph and inputs.shape[0] == self.batch_size:
+                    if graph is None:
+                        graph, static_inputs, static_targets, static_loss = self._capture_train_step(training_loss, optimizer, inputs, targets)
+                    static_inputs.copy_(inputs, non_blocking=True)
+                    static_targets.copy_(targets, non_blocking=True)
+                    graph.replay()
+                    loss = static_loss
+                else:
+                    loss = training_loss(inputs, targets)
+                    # The captured step owns the .grad tensors, so they must be zeroed rather than freed
+                    optimizer.zero_grad(set_to_none=not use_graph)
+                    # bfloat16 keeps float32's exponent range, so autocast needs no loss scaling
+                    loss.backward()
+                    optimizer.step()
+                if self.verbose and is_main:
+                    batch_losses.append(loss.detach().clone())
+            if batch_losses:
+                # A single device to host copy for the epoch instead of a sync on every batch
+                for i, batch_loss in zip(range(0, x_epoch.shape[0], self.batch_size), torch.stack(batch_losses).tolist()):
+                    print("  batch ({}/{}), train loss:{:.4f}".format(i, x_epoch.shape[0], batch_loss))
+            if epoch % self.eval_every == 0 or epoch == self.num_epochs - 1:
+                set_training(dropout_modules, False)
+                start = time.time()
 
-                targets = Variable(labels, requires_grad=False).long()
-                loss = criterion(y_pred, targets)
-                if self.verbose:
-                    print("  batch ({}/{})".format(i, x_train.shape[0]) + ", train loss:" + "{0:.4f}".format(loss))
-
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-            self.eval()
-            start = time.time()
-
-            auc = {'train': 0., 'valid': 0.}
-            if self.evaluate_train:
-                res = []
-                for i in range(0, x_train.shape[0], self.batch_size):
-                    inputs = Variable(x_train[i:i + self.batch_size]).float()
-                    if self.on_cuda and not self.full_data_cuda:
-                        inputs = inputs.cuda()
-                    res.append(self(inputs).data.cpu().numpy())
-                y_hat = np.concatenate(res)
-                auc['train'] = self.metric(y_true, np.argmax(y_hat, axis=1))
-
-            res = []
-            for i in range(0, x_valid.shape[0], self.batch_size):
-                inputs = Variable(x_valid[i:i + self.batch_size]).float()
-                if self.on_cuda and not self.full_data_cuda:
-                    inputs = inputs.cuda()
-                res.append(self(inputs).data.cpu().numpy())
-            y_hat = np.concatenate(res)
-            auc['valid'] = self.metric(y_valid, np.argmax(y_hat, axis=1))
-            patience = patience - 1
-            if patience == 0:
-                break
-            if (max_valid < auc['valid']) and epoch > 5:
-                max_valid = auc['valid']
-                patience = self.start_patience
-                self.best_model = self.state_dict().copy()
-            if self.verbose:
-                print("epoch: " + str(epoch) + ", time: " + "{0:.2f}".format(time.time() - start) + ", valid_metric: " + "{0:.2f}".format(auc['valid']) + ", train_metric: " + "{0:.2f}".format(auc['train']))
+                auc = {'train': 0., 'valid': 0.}
+                with torch.inference_mode():
+                    if self.evaluate_train:
+                        auc['train'] = self.metric(y_true, np.argmax(self._predict_batches(x_train), axis=1))
+                    auc['valid'] = self.metric(y_valid, np.argmax(self._predict_batches(x_valid), axis=1))
+                set_training(dropout_modules, True)
+                patience = patience - 1
+                if patience == 0:
+                    break
+                if (max_valid < auc['valid']) and epoch > 5:
+                    max_valid = auc['valid']
+                    patience = self.start_patience
+                    self.best_model = self.state_dict().copy()
+                if self.verbose and is_main:
+                    print("epoch: {}, time: {:.2f}, valid_metric: {:.2f}, train_metric: {:.2f}".format(epoch, time.time() - start, auc['valid'], auc['train']))
             if self.scheduler:
                 scheduler.step()
-        if self.verbose:
+        if self.verbose and is_main:
             print("total train time:" + "{0:.2f}".format(time.time() - all_time) + " for epochs: " + str(epoch))
+        # Training flipped only the dropout modules around evaluation; hand back a model in eval mode
+        self.eval()
         self.load_state_dict(self.best_model)
         self.best_model = None
 
+    def _capture_train_step(self, training_loss, optimizer, inputs, targets):
+        """
+        Capture forward, backward and optimizer step as a CUDA graph, to be replayed on every full size batch.
+        Following the PyTorch recipe, a few warmup steps are run on a side stream before capturing;
+        their updates are rolled back so training starts from the same point as the eager loop.
+        Called on the first batch, while the Adam state is still freshly initialised.
+        """
+        static_inputs, static_targets = inputs.clone(), targets.clone()
+        initial_params = [param.detach().clone() for param in self.parameters()]
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                optimizer.zero_grad(set_to_none=True)
+                training_loss(static_inputs, static_targets).backward()
+                optimizer.step()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        optimizer.zero_grad(set_to_none=True)
+        with torch.cuda.graph(graph):
+            static_loss = training_loss(static_inputs, static_targets)
+            static_loss.backward()
+            optimizer.step()
+
+        # Capturing only records kernels, so the warmup steps are the only updates to undo
+        with torch.no_grad():
+            for param, initial in zip(self.parameters(), initial_params):
+                param.copy_(initial)
+            for state in optimizer.state.values():
+                for value in state.values():
+                    if torch.is_tensor(value):
+                        value.zero_()
+        return graph, static_inputs, static_targets, static_loss
+
+    def _predict_batches(self, x):
+        res = []
+        for inputs in get_every_n(x, self.batch_size):
+            if self.on_cuda and not self.full_data_cuda:
+                inputs = inputs.cuda(non_blocking=True)
+            res.append(self(inputs).cpu().numpy())
+        return np.concatenate(res)
+
+    def enable_monitoring(self):
+        """
+        Keep the input and output of every layer on its last forward pass, for get_representation.
+        Off by default since the saved tensors keep each step's activations alive.
+        """
+        if not self.monitor_hooks:
+            self.monitor_hooks = [module.register_forward_hook(save_computations) for module in self.modules() if module is not self]
+
+    def disable_monitoring(self):
+        for hook in self.monitor_hooks:
+            hook.remove()
+        self.monitor_hooks = []
+
     def predict(self, inputs, probs=True):
         """
         Run the trained model on the inputs
@@ -156,9 +276,8 @@ class Model(nn.Module):
         inputs: Input to the model
         probs (bool): Get probability estimates
         """
-        inputs = torch.FloatTensor(np.expand_dims(inputs, axis=2))
-        if self.on_cuda:
-            inputs = inputs.cuda()
+        # Follow wherever the model's parameters live, rather than the cuda flag it was built with
+        inputs = torch.as_tensor(np.expand_dims(inputs, axis=2), dtype=torch.float32, device=next(self.parameters()).device)
         out = self.forward(inputs)
         if probs:
             out = F.softmax(out, dim=1)
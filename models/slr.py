@@ -1,7 +1,5 @@
-import logging
 from models.models import Model
 from models.utils import *
-import torch.nn.functional as F
 import torch
 from torch import nn
 
@@ -13,31 +11,34 @@ class SLR(Model):
         self.nb_nodes = self.X.shape[1]
         self.in_dim = 1
         self.out_dim = 2
-        self.adj.setdiag(0.)
-        self.laplacian = torch.FloatTensor(norm_laplacian(self.adj).toarray())
+        # Work on a copy so the caller's adjacency keeps its diagonal
+        adj = sparse.csr_matrix(self.adj, copy=True)
+        adj.setdiag(0.)
+        adj.eliminate_zeros()
+        # Stored transposed so the penalty |W| L can be computed as a sparse-dense product (L^T |W|^T)^T
+        laplacian = sparse.csr_matrix(norm_laplacian(adj).T)
+        self.register_buffer('laplacian', torch.sparse_csr_tensor(torch.from_numpy(laplacian.indptr.astype(np.int64)),
+                                                                  torch.from_numpy(laplacian.indices.astype(np.int64)),
+                                                                  torch.from_numpy(laplacian.data.astype(np.float32)),
+                                                                  size=laplacian.shape), persistent=False)
 
         # The logistic layer.
         logistic_in_dim = self.nb_nodes * self.in_dim
         logistic_layer = nn.Linear(logistic_in_dim, self.out_dim)
-        logistic_layer.register_forward_hook(save_computations)
         self.my_logistic_layers = nn.ModuleList([logistic_layer])
 
         torch.manual_seed(self.seed)
         if self.on_cuda:
-            torch.cuda.manual_seed(self.seed)
             torch.cuda.manual_seed_all(self.seed)
             self.cuda()
 
     def forward(self, x):
         nb_examples, nb_nodes, nb_channels = x.size()
-        x = x.view(nb_examples, -1)
+        x = torch.flatten(x, 1)
         x = self.my_logistic_layers[-1](x)
         return x
 
     def regularization(self, reg_lambda):
-        laplacian = torch.Variable(self.laplacian, requires_grad=False)
-        if self.on_cuda:
-            laplacian = laplacian.cuda()
-        weight = self.my_logistic_layers[-1].weight
-        reg = torch.abs(weight).mm(laplacian) * torch.abs(weight)
+        weight = torch.abs(self.my_logistic_layers[-1].weight)
+        reg = torch.sparse.mm(self.laplacian, weight.t()).t() * weight
         return reg.sum() * reg_lambda
@@ -1,12 +1,6 @@
 import os
-import time
 import torch
-import glob
-import networkx as nx
 from torch import nn
-from torch.autograd import Variable
-from scipy import sparse
-from collections import defaultdict
 import sklearn
 import sklearn.cluster
 import joblib
@@ -41,7 +35,7 @@ def norm_laplacian(adj):
 
 # We have several methods for clustering the graph. We use them to define the shape of the model and pooling
 def hierarchical_clustering(adj, n_clusters, verbose=True):
-    adj_hash = joblib.hash(adj.indices.tostring()) + joblib.hash(sparse.csr_matrix(adj).data.tostring()) + str(n_clusters)
+    adj_hash = joblib.hash(adj.indices.tobytes()) + joblib.hash(sparse.csr_matrix(adj).data.tobytes()) + str(n_clusters)
     path = cache_dir + "hierarchical" + '{}.npy'.format(adj_hash)
     if os.path.isfile(path):
         if verbose:
@@ -57,7 +51,7 @@ def hierarchical_clustering(adj, n_clusters, verbose=True):
     return clusters
 
 def random_clustering(adj, n_clusters):
-    adj_hash = joblib.hash(adj.data.tostring()) + joblib.hash(adj.indices.tostring()) + str(n_clusters)
+    adj_hash = joblib.hash(adj.data.tobytes()) + joblib.hash(adj.indices.tobytes()) + str(n_clusters)
     path = cache_dir + "random" + '{}.npy'.format(adj_hash)
     if os.path.isfile(path):
         clusters = np.load(path)
@@ -75,7 +69,7 @@ def random_clustering(adj, n_clusters):
     return clusters
 
 def kmeans_clustering(adj, n_clusters):
-    adj_hash = joblib.hash(adj.data.tostring()) + joblib.hash(adj.indices.tostring()) + str(n_clusters)
+    adj_hash = joblib.hash(adj.data.tobytes()) + joblib.hash(adj.indices.tobytes()) + str(n_clusters)
     path = cache_dir + "kmeans" + '{}.npy'.format(adj_hash)
 
     if os.path.isfile(path):
@@ -115,10 +109,55 @@ def setup_aggregates(adj, nb_layer, x, aggregation="hierarchy", agg_reduce=2, ve
         centroids.append(to_keep)
     return adjs, centroids
 
+def calculate_l1_loss(params, l1_lambda):
+    return l1_lambda * sum(param.abs().sum() for param in params)
+
 def save_computations(self, input, output):
-    setattr(self, "input", input)
-    setattr(self, "output", output)
+    # Detached so a monitored layer doesn't keep the whole autograd graph of its last forward alive
+    setattr(self, "input", tuple(i.detach() for i in input))
+    setattr(self, "output", output.detach() if torch.is_tensor(output) else tuple(o.detach() for o in output))
+
+def set_training(modules, mode):
+    for module in modules:
+        module.training = mode
+
 
 def get_every_n(a, n=2):
     for i in range(0, a.shape[0], n):
         yield a[i:i+n]
+
+
+class CUDAPrefetcher(object):
+    """
+    Wraps an iterable of batches of CPU tensors and copies the next batch to the GPU on a side stream
+    while the current one is being used, so the host to device transfer overlaps with compute.
+    The CPU tensors should be pinned for the copies to be asynchronous.
+    """
+    def __init__(self, batches):
+        self.batches = iter(batches)
+        self.stream = torch.cuda.Stream()
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.batches)
+        except StopIteration:
+            self.next_batch = None
+            return
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            self.next_batch = [t.cuda(non_blocking=True) for t in batch]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+        for t in batch:
+            # The tensors were allocated on the side stream but are consumed on the current one
+            t.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch
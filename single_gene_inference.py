@@ -1,3 +1,4 @@
+import os
 import pickle
 import argparse
 import traceback
@@ -5,7 +6,6 @@ import traceback
 import pandas as pd
 import numpy as np
 
-import itertools
 import sklearn
 import torch
 
@@ -28,10 +28,16 @@ parser.add_argument('--results', default='all_nodes', type=str,
                     help='Name of file to save results to. Default - all_nodes')
 parser.add_argument('--seed', default=0, type=int, help='Seed for training')
 parser.add_argument('--rand', default=False, type=bool, help='Randomize graph ?')
+parser.add_argument('--world-size', default=int(os.environ.get('WORLD_SIZE', 1)), type=int,
+                    help='Number of processes for DistributedDataParallel training. Default - 1, no DDP')
+parser.add_argument('--local-rank', default=int(os.environ.get('LOCAL_RANK', 0)), type=int,
+                    help='GPU used by this process when training with DDP')
+parser.add_argument('--dist-backend', default='nccl', type=str, help='torch.distributed backend used with DDP')
 
 args = parser.parse_args()
 print(args)
 seed = args.seed
+is_main = int(os.environ.get('RANK', 0)) == 0  # only the first DDP process writes the results
 randomize = args.rand
 
 # Setup the results dictionary
@@ -107,14 +113,8 @@ if args.graph and args.graph == 'landmark':
 print("Number of covered genes", len(which_genes))
 
 # Create the set of all experiment ids and see which are left to do
-columns = ["gene"]
-all_exp_ids = [x for x in itertools.product(which_genes)]
-all_exp_ids = pd.DataFrame(all_exp_ids, columns=columns)
-all_exp_ids.index = ["-".join(map(str, tup[1:])) for tup in all_exp_ids.itertuples(name=None)]
-results_exp_ids = results[columns].copy()
-results_exp_ids.index = ["-".join(map(str, tup[1:])) for tup in results_exp_ids.itertuples(name=None)]
-intersection_ids = all_exp_ids.index.intersection(results_exp_ids.index)
-todo = all_exp_ids.drop(intersection_ids).sort_values(by='gene').to_dict(orient="records")
+done_genes = frozenset(str(gene) for gene in results["gene"])
+todo = [{"gene": gene} for gene in sorted(which_genes) if str(gene) not in done_genes]
 
 print("todo: " + str(len(todo)))
 print("done: " + str(len(results)))
@@ -129,7 +129,8 @@ for row in tqdm(todo, desc=name):
                 train_valid_split=0.5, cuda=cuda, metric=sklearn.metrics.roc_auc_score,
                 channels=16, batch_size=10, lr=0.0007, weight_decay=0.00000001,
                 verbose=False, patience=5, num_epochs=10, seed=seed,
-                full_data_cuda=True, evaluate_train=False)
+                full_data_cuda=True, evaluate_train=False,
+                world_size=args.world_size, local_rank=args.local_rank, dist_backend=args.dist_backend)
 
     experiment = {
         "gene": gene,
@@ -149,7 +150,8 @@ for row in tqdm(todo, desc=name):
                                                                                     random_state=seed)
 
     except ValueError:
-        results = record_result(results, experiment, filename)
+        if is_main:
+            results = record_result(results, experiment, filename)
         continue
     if is_first_degree:
         if is_landmark:
@@ -177,4 +179,5 @@ for row in tqdm(todo, desc=name):
         tb = traceback.format_exc()
         experiment['error'] = tb
 
-    results = record_result(results, experiment, filename)
\ No newline at end of file
+    if is_main:
+        results = record_result(results, experiment, filename)
\ No newline at end of file
@@ -0,0 +1,30 @@
+import importlib.util
+import unittest
+import numpy as np
+import scipy.sparse
+import torch
+from models.gcn import GCN
+
+
+class GCNTestSuite(unittest.TestCase):
+    """Test cases on the GCN in gcn.py."""
+
+    @unittest.skipUnless(importlib.util.find_spec("torchao"), "needs torchao")
+    def test_to_inference_quantizes_gate_and_attention(self):
+        np.random.seed(0)
+        torch.manual_seed(0)
+        X = np.random.randn(40, 30).astype("float32")
+        y = (X[:, 0] > 0).astype(int)
+        adj = scipy.sparse.random(30, 30, density=0.1, random_state=0, format='csr')
+        adj = ((adj + adj.T) > 0).astype("float32")
+
+        model = GCN(num_layer=2, channels=8, embedding=4, gating=1., aggregation=None, num_epochs=1, verbose=False, seed=0)
+        model.attention_head = 2
+        model.fit(X, y, adj)
+        expected = model.predict(X)
+
+        model.to_inference()
+        layers = list(model.gating_layers) + [model.attention_layer]
+        for layer in layers:
+            self.assertEqual(layer.attn.weight.qdata.dtype, torch.int8)
+        self.assertTrue(np.allclose(model.predict(X), expected, atol=0.05))
@@ -0,0 +1,72 @@
+import unittest
+import scipy.sparse
+import torch
+import torch.nn.functional as F
+from models.gcn_layers import GCNLayer, EmbeddingLayer, StaticElementwiseGateLayer
+
+
+class GCNLayerTestSuite(unittest.TestCase):
+    """Test cases on the GCNLayer in gcn_layers.py."""
+
+    def conv1d_reference(self, layer, adj, x):
+        # The layer as written with the Conv1d modules and a dense adjacency
+        x = x.permute(0, 2, 1)
+        eye_x = layer.eye_linear(x)
+        x = torch.matmul(x, torch.FloatTensor(adj.toarray()).t())
+        x = F.relu(torch.cat([layer.linear(x), eye_x], dim=1))
+        x = torch.index_select(x, 2, layer.centroids)
+        return x.permute(0, 2, 1)
+
+    def check_against_conv1d(self, adj):
+        torch.manual_seed(0)
+        nb_nodes = adj.shape[0]
+        layer = GCNLayer(adj, in_dim=3, channels=8, id_layer=0, centroids=torch.arange(nb_nodes))
+        x = torch.randn(4, nb_nodes, 3)
+
+        out = layer(x)
+        out.sum().backward()
+        grads = [p.grad.clone() for p in layer.parameters()]
+        layer.zero_grad()
+
+        expected = self.conv1d_reference(layer, adj, x)
+        expected.sum().backward()
+        self.assertTrue(torch.allclose(out, expected, atol=1e-5))
+        for grad, p in zip(grads, layer.parameters()):
+            self.assertTrue(torch.allclose(grad, p.grad, atol=1e-4))
+
+    def test_sparse_adjacency_matches_conv1d(self):
+        adj = scipy.sparse.random(20, 20, density=0.1, random_state=0, format='csr')
+        adj = adj + adj.T
+        self.assertEqual(GCNLayer(adj, centroids=torch.arange(20)).adj_matrix.layout, torch.sparse_csr)
+        self.check_against_conv1d(adj)
+
+    def test_dense_adjacency_matches_conv1d(self):
+        adj = scipy.sparse.random(20, 20, density=0.6, random_state=0, format='csr')
+        adj = adj + adj.T
+        self.assertEqual(GCNLayer(adj, centroids=torch.arange(20)).adj_matrix.layout, torch.strided)
+        self.check_against_conv1d(adj)
+
+
+class EmbeddingLayerTestSuite(unittest.TestCase):
+    """Test cases on the EmbeddingLayer in gcn_layers.py."""
+
+    def test_output_permutes_to_gcn_layout_without_copy(self):
+        layer = EmbeddingLayer(50, 8)
+        x = torch.randn(4, 50, 1)
+        out = layer(x)
+        self.assertTrue(torch.allclose(out, x * layer.emb))
+        self.assertEqual(out.stride(), (400, 1, 50))
+        self.assertTrue(out.permute(0, 2, 1).is_contiguous())
+
+
+class StaticElementwiseGateLayerTestSuite(unittest.TestCase):
+    """Test cases on the StaticElementwiseGateLayer in gcn_layers.py."""
+
+    def test_gate_is_a_trained_parameter(self):
+        gate = StaticElementwiseGateLayer(in_dim=4, nb_nodes=7)
+        self.assertEqual([name for name, _ in gate.named_parameters()], ['attn'])
+
+        x = torch.randn(2, 7, 4)
+        (gate(x) * x).sum().backward()
+        self.assertEqual(gate.attn.grad.shape, (7,))
+        self.assertTrue(torch.allclose(gate(x), torch.sigmoid(torch.ones(7, 1))))
@@ -0,0 +1,36 @@
+import unittest
+import numpy as np
+import torch
+from models.mlp import MLP
+
+
+class FitTestSuite(unittest.TestCase):
+    """Test cases on Model.fit in models.py."""
+
+    def test_predict_is_deterministic_after_fit_with_dropout(self):
+        np.random.seed(0)
+        X = np.random.randn(40, 15).astype("float32")
+        y = (X[:, 0] > 0).astype(int)
+        model = MLP(num_layer=2, channels=8, dropout=True, num_epochs=2, verbose=False)
+        model.fit(X, y)
+        self.assertFalse(model.training)
+        self.assertTrue(torch.equal(model.predict(X), model.predict(X)))
+
+    def test_reg_lambda_without_regularization_raises(self):
+        X = np.random.randn(10, 15).astype("float32")
+        y = (X[:, 0] > 0).astype(int)
+        model = MLP(num_layer=2, channels=8, reg_lambda=0.5, num_epochs=1, verbose=False)
+        with self.assertRaises(Exception):
+            model.fit(X, y)
+
+    @unittest.skipUnless(torch.cuda.is_available(), "needs a GPU")
+    def test_cuda_graph_matches_eager_training(self):
+        np.random.seed(0)
+        X = np.random.randn(50, 15).astype("float32")
+        y = (X[:, 0] > 0).astype(int)
+        # 40 training examples in batches of 16 leave a partial batch that runs eagerly
+        kwargs = dict(num_layer=2, channels=8, num_epochs=3, batch_size=16, scheduler=True, cuda=True, verbose=False)
+        eager, graph = MLP(**kwargs), MLP(cuda_graph=True, **kwargs)
+        eager.fit(X, y)
+        graph.fit(X, y)
+        self.assertTrue(torch.allclose(eager.predict(X), graph.predict(X), atol=1e-5))
@@ -0,0 +1,36 @@
+import unittest
+import numpy as np
+import scipy.sparse
+import torch
+from models.slr import SLR
+from models.utils import norm_laplacian
+
+
+class SLRTestSuite(unittest.TestCase):
+    """Test cases on the SparseLogisticRegression in slr.py."""
+
+    def setUp(self):
+        np.random.seed(0)
+        self.X = np.random.randn(40, 15).astype("float32")
+        self.y = (self.X[:, 0] > 0).astype(int)
+        adj = scipy.sparse.random(15, 15, density=0.2, random_state=0, format='csr')
+        self.adj = (adj + adj.T + scipy.sparse.eye(15)).tocsr()
+
+    def test_regularization_matches_dense_penalty(self):
+        model = SLR(num_epochs=0, verbose=False)
+        model.fit(self.X, self.y, self.adj)
+
+        adj = self.adj.copy()
+        adj.setdiag(0.)
+        adj.eliminate_zeros()
+        laplacian = torch.FloatTensor(norm_laplacian(adj).toarray())
+        weight = torch.abs(model.my_logistic_layers[-1].weight)
+        expected = (weight.mm(laplacian) * weight).sum() * 0.5
+        self.assertTrue(torch.allclose(model.regularization(0.5), expected, rtol=1e-5))
+
+    def test_fit_does_not_modify_adjacency(self):
+        adj = self.adj.copy()
+        SLR(num_epochs=1, verbose=False).fit(self.X, self.y, adj)
+        self.assertTrue((adj != self.adj).nnz == 0)
+        self.assertTrue((adj.diagonal() != 0).all())
+